@@ -1,19 +1,38 @@
 import time
 import math
+import atexit
 import random
-from cards import Deck, Hand
+import os
+import bisect
+import ctypes
+import functools
+import itertools
+import multiprocessing
+from cards import Deck, Hand, CARD_POINTS
 from abc import ABC, abstractmethod
-from copy import deepcopy
-from collections import defaultdict
 import numpy as np
 
+# Numba is optional: without it MCTS rollouts run in plain Python
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 
 class Agent(ABC):
 
+    __slots__ = ("deck", "hand")
+
     def __init__(self, deck: Deck = None):
         self.deck = deck
         self.hand = Hand()
 
+    def reset(self):
+        """
+        Empties the hand for a new round, keeping the agent.
+        """
+        self.hand.reset()
+
     def hit(self):
         """
         Adds a card to the hand.
@@ -27,22 +46,56 @@ class Agent(ABC):
         """
         pass
 
+    def play_turn(self, opponent_hand: Hand):
+        """
+        Hits until the policy stands or the hand busts.
+        """
+        while self.policy(opponent_hand):
+            self.hit()
+            if self.hand.value > 21:
+                break
+
 
 class DealerAgent(Agent):
 
+    __slots__ = ()
+
     def policy(self, opponent_hand: Hand):
         """
         Base dealer policy: hits if value under 17.
         """
         return self.hand.value < 17
 
+    def play_turn(self, opponent_hand: Hand):
+        """
+        Hits until reaching 17, without going through policy and hit for every card.
+        """
+        hand = self.hand
+        deal_card = self.deck.deal_card
+        while hand.value < 17:
+            hand.add_card(deal_card())
+
+    def hit_table(self):
+        """
+        Returns whether the policy hits for every state of QLearnAgent._get_state, as a bool array
+        indexed by (dealer value, player value, has ace, heat index).
+        """
+        table = np.zeros((12, 22, 2, len(HEAT_INDEX)), dtype=bool)
+        table[:, :17] = True
+        return table
+
 
 
 
 class QLearnAgent(Agent):
-    def __init__(self, deck, q_table=None, alpha=0.3, gamma=0.9, epsilon=.2, alpha_decay=0.999):
+
+    __slots__ = ("q_table", "alpha", "gamma", "epsilon", "alpha_decay", "_state_cache", "_training_hand",
+                 "_random", "_generator")
+
+    def __init__(self, deck, q_table=None, alpha=0.3, gamma=0.9, epsilon=.2, alpha_decay=0.999, seed=None):
         """
         Initialize the Q-learning agent.
+            seed: seeds the exploration and batched training draws so training can be repeated
         """
         super().__init__(deck)
         self.q_table = q_table if q_table is not None else self.create_q_table() # Initialize Q-table
@@ -50,20 +103,17 @@ class QLearnAgent(Agent):
         self.gamma = gamma
         self.epsilon = epsilon
         self.alpha_decay = alpha_decay
+        self._state_cache = None # (opponent hand, versions, state) of the last _get_state call
+        self._training_hand = Hand() # dealer's hand of the training rounds
+        self._random = random.Random(seed) # random source of the exploration draws
+        self._generator = np.random.default_rng(seed) # random source of the batched training rounds
 
     def create_q_table(self): #DONE
         """
         create a Q-table with all possible states and actions
+            Note: indexed by (dealer value, player value, has ace, heat index, action)
         """
-        q_table = defaultdict(lambda: defaultdict(float))
-        for dealer_card in range(1, 12):
-            for player_value in range(1, 22):
-                for player_has_ace in [True, False]:
-                    for deck_heat in ['hot', 'nuetral','cold']:
-                        state = (dealer_card, player_value, player_has_ace, deck_heat)
-                        q_table[state]['hit'] = 0
-                        q_table[state]['stay'] = 0
-        return q_table
+        return np.zeros((12, 22, 2, len(HEAT_INDEX), len(ACTIONS)))
 
     def print_q_table(self): #DONE
         """
@@ -81,11 +131,18 @@ class QLearnAgent(Agent):
                 for player_value in range(11, 22):
                     print(player_value, end=' ')
                     for dealer_card in range(1, 11):
-                        state = (dealer_card, player_value, player_has_ace, deck_heat)
-                        print('H' if self.q_table[state]['hit'] > self.q_table[state]['stay'] else 'S', end=' ')
+                        state = (dealer_card, player_value, int(player_has_ace), HEAT_INDEX[deck_heat])
+                        print('H' if self.q_table[state + (HIT,)] > self.q_table[state + (STAND,)] else 'S', end=' ')
                     print()
                 print()
 
+    def hit_table(self):
+        """
+        Returns whether the greedy policy hits for every state, as a bool array
+        indexed like the Q-table without the action.
+        """
+        return self.q_table[..., HIT] > self.q_table[..., STAND]
+
     def policy(self, opponent_hand): #DONE
         """
         Decide the action (hit or stay) based on the Q-table for the given state
@@ -93,15 +150,24 @@ class QLearnAgent(Agent):
         # print the length of the hand
         # print(len(self.hand.cards))
         state = self._get_state(opponent_hand)
-        # if the state is new, we randomly choose an action
-        if state not in self.q_table:
-            return random.choice(['hit', 'stay'])
-        return  True if self.q_table[state]['hit'] > self.q_table[state]['stay'] else False
+        stand_value, hit_value = self.q_table[state].tolist()
+        return hit_value > stand_value
 
-    def train(self, rounds): #DONE
+    def train(self, rounds, batch_size=1): #DONE
         """
         Train the agent for a given number of rounds
+            batch_size: rounds played side by side with numpy per Q-table update
         """
+        if batch_size > 1:
+            played = 0
+            while played < rounds:
+                batch_rounds = min(batch_size, rounds - played)
+                self.deck.start_round()
+                self._play_batch(batch_rounds)
+                self.alpha = self.alpha * self.alpha_decay ** batch_rounds
+                played += batch_rounds
+            return self.q_table
+
         for _ in range(rounds):
             self.deck.start_round()
             self._play_round()
@@ -114,11 +180,12 @@ class QLearnAgent(Agent):
         """
         Play a single round for training
         """
-        # Setting up the hand for the round
-        self.hand = Hand()
-        opponent_hand = Hand()
-        self.hand.add_card(self.deck.deal_card())
-        self.hand.add_card(self.deck.deal_card())
+        # Setting up the hands for the round, reusing the training dealer's hand
+        opponent_hand = self._training_hand
+        self.hand.reset()
+        opponent_hand.reset()
+        player_cards = self.deck.deal_cards(2)
+        self.hand.add_cards(player_cards)
         opponent_hand.add_card(self.deck.deal_card())
         
         # Get the initial state
@@ -131,30 +198,110 @@ class QLearnAgent(Agent):
             if is_done: # if we're done, we get the reward from the new state
                 future_reward = self._get_intermediate_reward(initial_pos, action, new_state, opponent_hand) 
             else: # if we're not done, we get the max reward from the new state
-                future_reward = max(self.q_table[new_state].values())
+                future_reward = max(self.q_table[new_state].tolist())
             # update the q_table
-            result = self.q_table[initial_pos][action]
-            self.q_table[initial_pos][action] = (1 - self.alpha) * result + self.alpha * (reward + self.gamma * future_reward) # update the q_table using the equation from class
+            index = initial_pos + (action,)
+            result = self.q_table.item(index)
+            self.q_table[index] = (1 - self.alpha) * result + self.alpha * (reward + self.gamma * future_reward) # update the q_table using the equation from class
             initial_pos = new_state # set the new state to the initial state
 
 
+    def _play_batch(self, rounds):
+        """
+        Play several training rounds side by side as numpy arrays, applying each step's
+        Q-table updates together.
+            Note: every round deals from its own shuffle of the cards left in the deck, and an
+            entry updated by several rounds in one step moves toward their average target
+        """
+        q_table = self.q_table
+        q_values = q_table.reshape(-1)
+        generator = self._generator
+        rows = np.arange(rounds)
+        heat = np.full(rounds, HEAT_INDEX[self.deck.heat_bucket])
+
+        remaining_values = np.repeat(RANK_VALUES_ARRAY, self.deck.card_counts[2:12])
+        card_values = generator.permuted(np.tile(remaining_values, (rounds, 1)), axis=1)
+
+        # Setting up the hands for the rounds
+        player_value, player_aces = add_card_values(card_values[:, 0], (card_values[:, 0] == 11).astype(int),
+                                                    card_values[:, 1])
+        player_has_ace = ((card_values[:, 0] == 11) | (card_values[:, 1] == 11)).astype(int)
+        dealer_card = card_values[:, 2]
+        dealer_value = dealer_card.copy()
+        dealer_aces = (dealer_card == 11).astype(int)
+        next_card = np.full(rounds, 3)
+
+        active = np.ones(rounds, dtype=bool)
+        while active.any():
+            # Finished rounds keep being indexed (and masked out later), so busts are clipped
+            state = (dealer_card, np.minimum(player_value, 21), player_has_ace, heat)
+
+            # Epsilon-greedy actions
+            q_rows = q_table[state]
+            actions = (q_rows[:, HIT] > q_rows[:, STAND]).astype(int)
+            explore = generator.random(rounds) < self.epsilon
+            actions[explore] = generator.integers(0, 2, explore.sum())
+
+            hits = active & (actions == HIT)
+            stands = active & (actions == STAND)
+            drawn = card_values[rows, next_card]
+            next_card += hits
+            new_value, new_aces = add_card_values(player_value, player_aces, np.where(hits, drawn, 0))
+            player_value = np.where(hits, new_value, player_value)
+            player_aces = np.where(hits, new_aces, player_aces)
+            player_has_ace |= hits & (drawn == 11)
+            busts = active & (player_value > 21)
+
+            # Play out the dealer's turn for the rounds that stayed
+            dealing = stands & (dealer_value < 17)
+            while dealing.any():
+                drawn = card_values[rows, next_card]
+                next_card += dealing
+                new_value, new_aces = add_card_values(dealer_value, dealer_aces, drawn)
+                dealer_value = np.where(dealing, new_value, dealer_value)
+                dealer_aces = np.where(dealing, new_aces, dealer_aces)
+                dealing &= dealer_value < 17
+
+            # Rewards of finished rounds, otherwise the max reward from the new state
+            outcome = np.sign(player_value - dealer_value)
+            outcome[dealer_value > 21] = 1
+            outcome[busts] = -1
+            done = busts | stands
+            new_state = (dealer_card, np.minimum(player_value, 21), player_has_ace, heat)
+            future_reward = np.where(done, outcome, q_table[new_state].max(axis=1))
+
+            # Update the q_table, averaging the targets of rounds sharing an entry
+            index = np.ravel_multi_index(state + (actions,), q_table.shape)[active]
+            target = (self.gamma * future_reward)[active]
+            counts = np.bincount(index, minlength=q_values.size)
+            targets = np.bincount(index, weights=target, minlength=q_values.size)
+            updated = counts > 0
+            q_values[updated] = (1 - self.alpha) * q_values[updated] + self.alpha * targets[updated] / counts[updated]
+
+            active &= ~done
+
+        # The shared deck moves on by one round's worth of cards so its heat keeps changing
+        for _ in range(next_card[0]):
+            self.deck.deal_card()
+
     def _choose_action(self, state):
         """
         Choose action based on the current state using an epsilon-greedy strategy
         """
-        if random.random() < self.epsilon or state not in self.q_table:  # Epsilon-greedy exploration
-            return random.choice(['hit', 'stay'])
+        if self._random.random() < self.epsilon:  # Epsilon-greedy exploration
+            return self._random.getrandbits(1)
         else:  # Exploitation
-            return 'hit' if self.q_table[state]['hit'] > self.q_table[state]['stay'] else 'stay'
+            stand_value, hit_value = self.q_table[state].tolist()
+            return HIT if hit_value > stand_value else STAND
 
     def _take_action(self, action, opponent_hand):
         """
         Take the chosen action and find out the reward and new state
         """
-        if action == 'hit':
+        if action == HIT:
             self.hit()
         new_state = self._get_state(opponent_hand) # get us the new state from hitting
-        is_done = (self.hand.value > 21) or (action == 'stay') # if we bust or stay, we're done
+        is_done = (self.hand.value > 21) or (action == STAND) # if we bust or stay, we're done
         return new_state, is_done
     
     def _get_intermediate_reward(self, state, action, new_state, opponent_hand):
@@ -165,11 +312,13 @@ class QLearnAgent(Agent):
         if new_state[1] > 21:
             return -1
         # if we stay, we get a reward of 0
-        elif action == 'stay':
-            # we need to play out the dealer's turn to get the reward
-            while opponent_hand.value < 17:
-                opponent_hand.add_card(self.deck.deal_card())
-            outcome = self._determine_outcome(opponent_hand)
+        elif action == STAND:
+            # we need to play out the dealer's turn to get the reward,
+            # tracked as plain ints since the dealer's hand is not used afterwards
+            dealer_value, dealer_aces = opponent_hand.value, int(opponent_hand.is_soft)
+            while dealer_value < 17:
+                dealer_value, dealer_aces = add_card_value(dealer_value, dealer_aces, CARD_POINTS[self.deck.deal_card()])
+            outcome = self._determine_outcome(dealer_value)
             reward = self._get_reward(outcome)
             return reward
         # if we hit and get 21, we get a reward of 1
@@ -193,15 +342,15 @@ class QLearnAgent(Agent):
             # print("womp womp we tie")
             return 0
 
-    def _determine_outcome(self, opponent_hand):
+    def _determine_outcome(self, dealer_value):
         """
         Determine the outcome of the game based on the final hand values of the player and opponent. could merge with get_reward/replace with compute_winner
         """
         if self.hand.value > 21: # if we bust, we lose
             return 'lose'
-        elif opponent_hand.value > 21 or self.hand.value > opponent_hand.value: # if the dealer busts or we have a higher value, we win
+        elif dealer_value > 21 or self.hand.value > dealer_value: # if the dealer busts or we have a higher value, we win
             return 'win'
-        elif self.hand.value < opponent_hand.value: # if the dealer has a higher value, we lose
+        elif self.hand.value < dealer_value: # if the dealer has a higher value, we lose
             return 'lose'
         else:
             return 'tie'
@@ -209,18 +358,20 @@ class QLearnAgent(Agent):
     def _get_state(self, opponent_hand): # THIS WORKS
         """
         set the current state based on the game context
+            Note: reuses the last state until either hand or the deck changes
         """
+        versions = (opponent_hand.version, self.hand.version, self.deck.version)
+        cache = self._state_cache
+        if cache is not None and cache[0] is opponent_hand and cache[1] == versions:
+            return cache[2]
+
         dealer_value = opponent_hand.value
         player_value = self.hand.value
-        player_has_ace = 'A' in [card.value for card in self.hand.cards]
-        # print(len(self.hand.cards))
-        if self.deck.heat < -3:
-            deck_heat = 'cold'
-        elif self.deck.heat > 3:
-            deck_heat = 'hot'
-        else:
-            deck_heat = 'nuetral'
-        return (dealer_value, player_value, player_has_ace, deck_heat)
+        player_has_ace = int(self.hand.aces > 0)
+        deck_heat = HEAT_INDEX[self.deck.heat_bucket]
+        state = (dealer_value, player_value, player_has_ace, deck_heat)
+        self._state_cache = (opponent_hand, versions, state)
+        return state
 
 
 
@@ -228,101 +379,398 @@ class QLearnAgent(Agent):
 class MonteCarloAgent(Agent):
     """
     MonteCarloAgent utilizes MonteCarlo methods to determine whether to hit or not.
+
+    Search options (all passed as keyword arguments, e.g. through Game's player_args):
+        explore_time: seconds of search per decision
+        num_simulations: fixed number of search iterations, replacing explore_time
+        num_parallel_sims: leaves selected per iteration using virtual loss
+        rollouts_per_leaf: random simulations per leaf, batched with numpy when above 1
+        use_transpositions: share nodes between identical hands (graph search)
+        resample_hits: re-deal hit cards on every descent instead of once at expansion
+        num_workers: independent searches run in parallel processes
     """
 
+    __slots__ = ("explore_time", "num_simulations", "num_parallel_sims", "rollouts_per_leaf",
+                 "use_transpositions", "resample_hits", "num_workers", "_last_search")
+
+    Defaults = {
+        "explore_time": 0.005,
+        "num_simulations": None,
+        "num_parallel_sims": 1,
+        "rollouts_per_leaf": 1,
+        "use_transpositions": False,
+        "resample_hits": True,
+        "num_workers": 1,
+    }
+
     def __init__(self, deck: Deck = None, **kwargs):
         super().__init__(deck)
-        self.explore_time = kwargs.get("explore_time", 0.005)
+        unknown_options = set(kwargs) - set(MonteCarloAgent.Defaults)
+        if unknown_options:
+            raise TypeError(f"Unknown MonteCarloAgent options: {sorted(unknown_options)}")
+
+        options = {**MonteCarloAgent.Defaults, **kwargs}
+        self.explore_time = options["explore_time"]
+        self.num_simulations = options["num_simulations"]
+        self.num_parallel_sims = options["num_parallel_sims"]
+        self.rollouts_per_leaf = options["rollouts_per_leaf"]
+        self.use_transpositions = options["use_transpositions"]
+        self.resample_hits = options["resample_hits"]
+        self.num_workers = options["num_workers"]
+
+        # Transposition table of the last search with the hands it was made for,
+        # continued by the next decision of the same round
+        self._last_search = None
+
+    def reset(self):
+        """
+        Empties the hand for a new round and drops the last round's transposition table.
+        """
+        self.hand.reset()
+        self._last_search = None
 
     def policy(self, opponent_hand: Hand):
         """
         Utilizes MonteCarlo methods to determine whether to hit or not.
         """
 
-        start_state = BlackjackStateMCTS(self.hand, opponent_hand, self.deck)
+        start_state = BlackjackStateMCTS.from_game(self.hand, opponent_hand, self.deck)
 
         # Edge case: if player has >= 21 then game over
         if start_state.is_terminal():
             return False
 
-        root = MonteCarloNode(start_state, None)
+        search_args = (start_state, self.explore_time, self.num_parallel_sims, self.use_transpositions,
+                       self.rollouts_per_leaf, self.num_simulations, self.resample_hits)
+        if self.num_workers > 1:
+            # Root parallelization: independent trees per worker, merged at the root
+            seeds = [mcts_random.getrandbits(32) for _ in range(self.num_workers)]
+            child_stats = get_mcts_pool(self.num_workers).starmap(
+                run_mcts_budget, [search_args + (seed,) for seed in seeds])
+            root = MonteCarloNode.from_child_stats(start_state, child_stats)
+        elif self.use_transpositions:
+            node_table = self._get_reusable_table(opponent_hand)
+            root = run_mcts(*search_args, node_table)
+            self._last_search = (opponent_hand, opponent_hand.version, self.hand.version, node_table)
+        else:
+            root = run_mcts(*search_args)
+
+        # If given no time to explore, defaults to False (stand)
+        if root.total_visits == 0:
+            return False
+
+        node = root.get_most_visited_child()
 
-        start_time = time.time()
-        while time.time() - start_time < self.explore_time:
+        return bool(node.parent_action)
 
-            # Gets the leaf node in the UCB tree
-            node = root.find_leaf_node()
+    def _get_reusable_table(self, opponent_hand: Hand):
+        """
+        Returns the last search's transposition table if only the hit it chose has happened since.
+            Note: the table is keyed by the player's hand, so after the hit it holds the node
+            for the hand actually dealt
+        """
+        if self._last_search is None:
+            return {}
+        last_opponent_hand, opponent_version, hand_version, node_table = self._last_search
+        if (last_opponent_hand is opponent_hand and opponent_hand.version == opponent_version
+                and self.hand.version == hand_version + 1):
+            return node_table
+        return {}
 
-            # Determines the random terminal value of the node
-            reward = node.simulate()
 
-            # Updates the rewards of the parents
-            node.update_rewards(reward)
+# Rank order used for the deck counts of a BlackjackStateMCTS (faces collapse into "10"),
+# matching Deck.card_counts from index 2
+RANKS = ('2', '3', '4', '5', '6', '7', '8', '9', '10', 'A')
+RANK_VALUES = (2, 3, 4, 5, 6, 7, 8, 9, 10, 11)
+RANK_VALUES_ARRAY = np.array(RANK_VALUES)
+
+# Random sources of the python and numpy MCTS paths, reseeded in each worker process
+mcts_random = random.Random()
+mcts_generator = np.random.default_rng()
+
+# MCTS and Q-learning actions are coded as ints so a coin flip picks one
+STAND = 0
+HIT = 1
+ACTIONS = (HIT, STAND)
+
+# Rollouts always stand from this value (like the dealer) and flip a coin below it
+ROLLOUT_STAND_VALUE = 17
+
+# Q-table axis for the deck heat buckets of Deck.heat_bucket
+HEAT_INDEX = {'hot': 0, 'nuetral': 1, 'cold': 2}
+
+
+def add_card_value(value: int, aces: int, card_value: int):
+    """
+    Returns the (value, aces) of a hand after adding a card worth card_value.
+        Note: mirrors Hand.add_card without building a Hand
+    """
+    value += card_value
+    if card_value == 11:
+        aces += 1
+
+    # Count as many aces as 1 as it takes to get back to 21 or under
+    over = value - 21
+    if over > 0 and aces:
+        adjust = min(aces, (over + 9) // 10)
+        value -= 10 * adjust
+        aces -= adjust
+    return value, aces
+
+
+def add_card_values(values, aces, card_values):
+    """
+    Returns the (values, aces) arrays of several hands after adding a card to each.
+        Note: numpy version of add_card_value
+    """
+    values = values + card_values
+    aces = aces + (card_values == 11)
+    adjust = np.minimum(aces, np.maximum(values - 12, 0) // 10)
+    return values - 10 * adjust, aces - adjust
+
+
+def draw_rank_index(deck_counts, total: int):
+    """
+    Draws a random rank index weighted by (and removed from) the deck counts array.
+    """
+    pick = np.random.randint(0, total)
+    for rank in range(len(deck_counts)):
+        pick -= deck_counts[rank]
+        if pick < 0:
+            deck_counts[rank] -= 1
+            return rank
+    return len(deck_counts) - 1
+
+
+@functools.lru_cache(maxsize=100_000)
+def dealer_final_dist(dealer_value: int, dealer_aces: int, deck_counts: tuple):
+    """
+    Returns the probabilities of the dealer's policy finishing on 17, 18, 19, 20, 21 or busting.
+        Note: every draw uses the deck's current proportions (no removal)
+    """
+    total = sum(deck_counts)
+    draws = [(count / total, value) for count, value in zip(deck_counts, RANK_VALUES) if count]
+    dist = [0.0] * 6
+
+    # Probability mass of each dealer hand by hard total (aces as 1) and soft aces.
+    # Every card raises the hard total, so one ascending pass collects all of a
+    # hand's mass before it is drawn from
+    mass = [[0.0, 0.0] for _ in range(27)]
+    mass[dealer_value - 10 * dealer_aces][dealer_aces] = 1.0
+    for hard_value in range(27):
+        for aces in (0, 1):
+            hand_mass = mass[hard_value][aces]
+            if not hand_mass:
+                continue
+            value = hard_value + 10 * aces
+            if value >= 17:
+                dist[min(value, 22) - 17] += hand_mass
+                continue
+            for p, card_value in draws:
+                next_value, next_aces = add_card_value(value, aces, card_value)
+                mass[next_value - 10 * next_aces][next_aces] += hand_mass * p
+
+    return tuple(dist)
+
+
+@functools.lru_cache(maxsize=100_000)
+def terminal_payoffs(dealer_value: int, dealer_aces: int, deck_counts: tuple):
+    """
+    Returns the expected reward of standing on each player value from 0 to 22 (bust).
+        Note: rewards follow Hand.compute_winner (1 win, 0.5 tie, 0 loss)
+    """
+    dist = dealer_final_dist(dealer_value, dealer_aces, deck_counts)
+
+    # Below 17 the player only wins if the dealer busts
+    beaten = dist[5]
+    payoffs = [beaten] * 17
+    for p in dist[:5]:
+        payoffs.append(beaten + 0.5 * p)
+        beaten += p
+    payoffs.append(0.0)
+    return tuple(payoffs)
+
+
+def rollout(deck_counts, my_value: int, my_aces: int, stand: bool, payoffs):
+    """
+    Plays out the player's remaining actions at random (standing from ROLLOUT_STAND_VALUE) and scores the final hand.
+        deck_counts: array of remaining counts per rank in RANKS (modified in place)
+        payoffs: expected reward of each final player value (see terminal_payoffs)
+    """
+    total = deck_counts.sum()
+
+    # Player's random actions
+    while my_value < 21 and not stand:
+        if my_value >= ROLLOUT_STAND_VALUE or np.random.random() < 0.5:
+            stand = True
+        else:
+            rank = draw_rank_index(deck_counts, total)
+            total -= 1
+
+            # Inlined add_card_value
+            card_value = RANK_VALUES[rank]
+            my_value += card_value
+            if card_value == 11:
+                my_aces += 1
+            over = my_value - 21
+            if over > 0 and my_aces:
+                adjust = min(my_aces, (over + 9) // 10)
+                my_value -= 10 * adjust
+                my_aces -= adjust
+
+    return payoffs[min(my_value, 22)]
+
+
+def rollouts(deck_counts, my_value: int, my_aces: int, stand: bool, payoffs, n: int):
+    """
+    Returns the summed reward of n rollouts from the same state.
+        deck_counts: array of remaining counts per rank in RANKS (not modified)
+    """
+    total_reward = 0.0
+    for _ in range(n):
+        total_reward += rollout(deck_counts.copy(), my_value, my_aces, stand, payoffs)
+    return total_reward
+
+
+if njit is not None:
+    draw_rank_index = njit(cache=True)(draw_rank_index)
+    rollout = njit(cache=True)(rollout)
+    rollouts = njit(cache=True)(rollouts)
 
-        # If given no time to explore, defaults to False (stand)
-        if root.total_visits == 0:
-            return False
 
-        node = root.get_best_average_child()
+# Optional C version of rollout for batches of simulations, built with `make rollout`
+try:
+    rollout_lib = ctypes.CDLL(os.path.join(os.path.dirname(os.path.abspath(__file__)), "blackjack_rollout.so"))
+except OSError:
+    rollout_lib = None
 
-        return True if node.parent_action == "hit" else False
+DeckCountsArray = ctypes.c_int32 * len(RANKS)
+PayoffsArray = ctypes.c_double * 23
+
+def load_rollout_function(name: str, restype, argtypes):
+    """
+    Returns the named function of the C library with its signature set, or None when the library is
+    missing or was built from an older blackjack_rollout.c without it (rebuild with `make rollout`).
+    """
+    if rollout_lib is None or not hasattr(rollout_lib, name):
+        return None
+    function = getattr(rollout_lib, name)
+    function.restype = restype
+    function.argtypes = argtypes
+    return function
+
+c_rollouts = load_rollout_function(
+    "rollouts", ctypes.c_double,
+    [ctypes.POINTER(ctypes.c_int32), ctypes.c_int32, ctypes.c_int32, ctypes.c_int32,
+     ctypes.POINTER(ctypes.c_double), ctypes.c_int32, ctypes.POINTER(ctypes.c_uint64)])
+c_mcts_search = load_rollout_function(
+    "mcts_search", ctypes.c_int64,
+    [ctypes.POINTER(ctypes.c_int32), ctypes.c_int32, ctypes.c_int32, ctypes.c_int32,
+     ctypes.c_int32, ctypes.c_int32, ctypes.c_int64, ctypes.c_int64,
+     ctypes.POINTER(ctypes.c_uint64), ctypes.POINTER(ctypes.c_int64), ctypes.POINTER(ctypes.c_double)])
+
+c_play_shoe_rounds = load_rollout_function(
+    "play_shoe_rounds", None,
+    [ctypes.POINTER(ctypes.c_uint8), ctypes.c_int32, ctypes.POINTER(ctypes.c_int32), ctypes.POINTER(ctypes.c_int32),
+     ctypes.POINTER(ctypes.c_int32), ctypes.c_double, ctypes.POINTER(ctypes.c_uint8), ctypes.c_int64,
+     ctypes.POINTER(ctypes.c_uint64), ctypes.POINTER(ctypes.c_int64)])
+
+# xoshiro256** state of the C rollout, reseeded in each worker process
+rollout_rng_state = (ctypes.c_uint64 * 4)(*(mcts_random.getrandbits(64) | 1 for _ in range(4)))
+
+
+@functools.lru_cache(maxsize=100_000)
+def terminal_payoffs_array(dealer_value: int, dealer_aces: int, deck_counts: tuple):
+    """
+    Returns terminal_payoffs as a C array for the compiled rollout.
+    """
+    return PayoffsArray(*terminal_payoffs(dealer_value, dealer_aces, deck_counts))
+
+
+@functools.lru_cache(maxsize=100_000)
+def terminal_payoffs_numpy(dealer_value: int, dealer_aces: int, deck_counts: tuple):
+    """
+    Returns terminal_payoffs as a read-only numpy array for the numba and numpy rollouts.
+    """
+    payoffs = np.array(terminal_payoffs(dealer_value, dealer_aces, deck_counts))
+    payoffs.setflags(write=False)
+    return payoffs
 
 
 class BlackjackStateMCTS:
+    """
+    Lightweight MCTS game state: hands are (value, aces) pairs and the deck
+    is a tuple holding the remaining count of each rank in RANKS.
+        Note: states are never mutated, so nodes can share them freely
+    """
 
-    def __init__(self, my_hand: Hand, dealer_hand: Hand, deck: Deck) -> None:
-        self.my_hand = deepcopy(my_hand)
-        self.dealer_hand = deepcopy(dealer_hand)
-        self.deck = deepcopy(deck)
+    __slots__ = ("my_value", "my_aces", "dealer_value", "dealer_aces", "deck_counts", "stand")
+
+    def __init__(self, my_value: int, my_aces: int, dealer_value: int, dealer_aces: int,
+                 deck_counts: tuple, stand: bool = False) -> None:
+        self.my_value = my_value
+        self.my_aces = my_aces
+        self.dealer_value = dealer_value
+        self.dealer_aces = dealer_aces
+        self.deck_counts = deck_counts
 
         # True if player stands
-        self.stand = False
+        self.stand = stand
+
+    @classmethod
+    def from_game(cls, my_hand: Hand, dealer_hand: Hand, deck: Deck):
+        """
+        Builds the state from the live hands and deck of a game.
+        """
+        deck_counts = tuple(deck.card_counts[2:12])
+        return cls(my_hand.value, int(my_hand.is_soft), dealer_hand.value, int(dealer_hand.is_soft), deck_counts)
 
     def is_terminal(self):
-        return self.my_hand.value >= 21 or self.stand
+        return self.my_value >= 21 or self.stand
 
-    def get_actions(self):
-        return ["hit", "stand"]
+    def key(self):
+        """
+        Returns the signature of the player's position used by the transposition table.
+            Note: the dealer's hand is fixed during a search and the deck is ignored
+        """
+        return (self.my_value, self.my_aces, self.stand)
 
-    def find_terminal_value(self):
+    def get_actions(self):
+        return ACTIONS
 
-        # Create dealer agent with same hand!
-        dealer = DealerAgent(deepcopy(self.deck))
-        dealer.hand = deepcopy(self.dealer_hand)
+    def draw_rank(self):
+        """
+        Draws a random rank index weighted by the remaining deck counts.
+            Returns the rank index and the deck counts without that card
+        """
+        deck_counts = self.deck_counts
+        cumulative_counts = list(itertools.accumulate(deck_counts))
+        rank = bisect.bisect(cumulative_counts, mcts_random.random() * cumulative_counts[-1])
+        return rank, deck_counts[:rank] + (deck_counts[rank] - 1,) + deck_counts[rank + 1:]
 
-        # Simulate dealer's turn
-        while dealer.policy(self.my_hand):
-            dealer.hit()
+    def find_terminal_value(self):
+        """
+        Returns the expected reward of the player standing on the current hand.
+            Note: the dealer's turn is evaluated approximately instead of being simulated
+            (dealer draws ignore card removal, see dealer_final_dist)
+        """
+        return terminal_payoffs(self.dealer_value, self.dealer_aces, self.deck_counts)[min(self.my_value, 22)]
 
-        # Determine winner
-        winner = self.my_hand.compute_winner(dealer.hand)
-        return winner
-    
     def successor(self, action):
         """
         Returns the successor state of the current state given an action.
         """
-        next_state = deepcopy(self)
+        if action == HIT:
+            rank, deck_counts = self.draw_rank()
+            my_value, my_aces = add_card_value(self.my_value, self.my_aces, RANK_VALUES[rank])
+            return BlackjackStateMCTS(my_value, my_aces, self.dealer_value, self.dealer_aces, deck_counts)
 
-        if action == "hit":
-            next_state.my_hand.add_card(next_state.deck.deal_card())
-        else:
-            next_state.stand = True
-
-        return next_state
-    
-    def refresh_cards(self, parent_deck: Deck, parent_hand: Hand, parent_action: str):
-        """
-        Refreshes the cards in the game state.
-        """
-        self.deck = parent_deck
-        self.my_hand = parent_hand
-        if parent_action == "hit":
-            self.my_hand.add_card(self.deck.deal_card())
+        return BlackjackStateMCTS(self.my_value, self.my_aces, self.dealer_value, self.dealer_aces,
+                                  self.deck_counts, stand=True)
 
     def __str__(self) -> str:
         string_form = f""" ---
-        Hand: {self.my_hand}
+        Hand Value: {self.my_value}
         Stand: {self.stand}
         """
         return string_form
@@ -330,63 +778,138 @@ class BlackjackStateMCTS:
 
 class MonteCarloNode:
 
+    __slots__ = ("state", "parent", "parent_action", "total_visits", "total_rewards",
+                 "avg_reward", "children", "num_missing_actions", "ancestors")
+
     def __init__(self, state:BlackjackStateMCTS, parent=None, parent_action=None):
 
         self.state = state
         self.parent = parent
         self.parent_action = parent_action
 
+        # The node and all its parents, cached for back-propagation
+        self.ancestors = (self,) if parent is None else (self,) + parent.ancestors
+
         self.total_visits = 0
         self.total_rewards = 0
+        self.avg_reward = 0
 
-        self.children = []
-        self.missing_child_actions = self.state.get_actions()
+        # Children are indexed by their action, None until expanded
+        self.children = [None] * len(ACTIONS)
+        # Actions are expanded from the end of the shared ACTIONS tuple without copying it
+        self.num_missing_actions = len(ACTIONS)
+
+    @classmethod
+    def from_child_stats(cls, state: BlackjackStateMCTS, child_stats: list):
+        """
+        Builds a root whose children sum the statistics of several searches.
+            child_stats: list of {action: (visits, rewards)} from run_mcts_budget
+        """
+        root = cls(state)
+        root.num_missing_actions = 0
+        children = root.children
+        for stats in child_stats:
+            for action, (visits, rewards) in stats.items():
+                if children[action] is None:
+                    children[action] = cls(state, parent=root, parent_action=action)
+                children[action].total_visits += visits
+                children[action].total_rewards += rewards
+                root.total_visits += visits
+                root.total_rewards += rewards
+
+        for node in root.get_expanded_children() + [root]:
+            node.avg_reward = node.get_average_reward()
+        return root
 
     def is_fully_expanded(self):
         """
         Determines if the node is fully expanded.
         """
-        return len(self.missing_child_actions) == 0
+        return self.num_missing_actions == 0
 
     def get_average_reward(self):
         if self.total_visits == 0:
             return 0
         return self.total_rewards / self.total_visits
 
+    def get_expanded_children(self):
+        """
+        Returns the child nodes that have been expanded so far.
+        """
+        return [child for child in self.children if child is not None]
+
     def get_best_average_child(self):
         """
         Returns the child node with the best average reward.
         """
-        node = max(self.children, key = lambda x: x.get_average_reward())
+        best_node = None
+        best_average = -math.inf
+        for child in self.children:
+            if child is None or child.total_visits == 0:
+                continue
+            average = child.avg_reward
+            if average > best_average:
+                best_average = average
+                best_node = child
+        return best_node
+
+    def get_most_visited_child(self):
+        """
+        Returns the child node with the most visits (the robust child).
+        """
+        node = max(self.get_expanded_children(), key = lambda x: x.total_visits)
         return node
 
     def get_ucb_value(self, parent_total_visits):
         """
         Returns the UCB value of the node using parents visits and actor
+            Note: unvisited nodes have an infinite UCB value
         """
+        if self.total_visits == 0:
+            return math.inf
         value = self.get_average_reward() + math.sqrt(2 * math.log(parent_total_visits) / self.total_visits)
         return value
 
     def get_best_ucb_child(self):
         """
         Returns the child node with the best UCB value.
+            Note: only called on fully expanded nodes
         """
-        node = max(self.children, key = lambda x: x.get_ucb_value(self.total_visits))
-        return node
+        stand_node, hit_node = self.children
+
+        # Unvisited children are always explored first
+        stand_visits = stand_node.total_visits
+        if stand_visits == 0:
+            return stand_node
+        hit_visits = hit_node.total_visits
+        if hit_visits == 0:
+            return hit_node
+
+        # Hoist the parent's exploration term out of the per-child computation
+        exploration = math.sqrt(2 * math.log(self.total_visits))
+
+        stand_value = stand_node.avg_reward + exploration / math.sqrt(stand_visits)
+        hit_value = hit_node.avg_reward + exploration / math.sqrt(hit_visits)
+        return hit_node if hit_value > stand_value else stand_node
     
     def expand(self):
         """
         Expands the node by adding a new child node from an unexplored action.
         """
-        action = self.missing_child_actions.pop()
+        self.num_missing_actions -= 1
+        action = ACTIONS[self.num_missing_actions]
         next_state = self.state.successor(action)
         child_node = MonteCarloNode(next_state, parent=self, parent_action=action)
-        self.children.append(child_node)
+        self.children[action] = child_node
         return child_node
 
-    def find_leaf_node(self):
+    def find_leaf_node(self, node_table: dict = None, resample_hits: bool = True):
         """
         Returns the leaf node of the tree using UCB values.
+            node_table: optional transposition table, turning the tree into a graph
+            in which every dealt hand with the same key shares one node
+            resample_hits: re-deal each child's state on every descent; otherwise
+            children keep the state dealt when they were expanded
         """
         current_node = self
         while not current_node.state.is_terminal():
@@ -395,36 +918,109 @@ class MonteCarloNode:
                 return current_node.expand()
             else:
 
-                # Refresh node by building a fresh hand from parent node
-                current_node = current_node.get_best_ucb_child()
+                child = current_node.get_best_ucb_child()
 
-                current_node.state.refresh_cards(
-                    deepcopy(current_node.parent.state.deck),
-                    deepcopy(current_node.parent.state.my_hand), 
-                    current_node.parent_action)
+                # Re-deal the child's state from the current state (squashed chance node)
+                if resample_hits:
+                    state = current_node.state.successor(child.parent_action)
+                else:
+                    state = child.state
+
+                # Nodes may be reached along different paths, so the ancestors
+                # follow the path actually traversed
+                child.ancestors = (child,) + current_node.ancestors
+
+                if node_table is not None and child.parent_action == HIT:
+                    # Continue from the shared node for the dealt hand
+                    key = state.key()
+                    if key not in node_table:
+                        node_table[key] = MonteCarloNode(state, parent=child)
+                    current_node = node_table[key]
+                    current_node.ancestors = (current_node,) + child.ancestors
+                else:
+                    current_node = child
+
+                if resample_hits:
+                    current_node.state = state
 
         return current_node
     
-    def simulate(self):
+    def simulate(self, state: BlackjackStateMCTS = None):
         """
         Returns the terminal value of the node by randomly simulating game.
+            state: the state dealt to the node when it was selected, if not its current one
         """
-        state = self.state
+        if state is None:
+            state = self.state
+
+        # Compiled rollout kernel when numba is available
+        if njit is not None:
+            payoffs = terminal_payoffs_numpy(state.dealer_value, state.dealer_aces, state.deck_counts)
+            return rollout(np.array(state.deck_counts), state.my_value, state.my_aces, state.stand, payoffs)
+
+        random_action = mcts_random.getrandbits
         while not state.is_terminal():
-            state = state.successor(random.choice(state.get_actions()))
+            state = state.successor(STAND if state.my_value >= ROLLOUT_STAND_VALUE else random_action(1))
 
         payoff = state.find_terminal_value()
         return payoff
+
+    def simulate_batch(self, n: int, state: BlackjackStateMCTS = None):
+        """
+        Returns the summed terminal value of n random simulations of the node,
+        run in C when the rollout library is built, compiled with numba when
+        available and as numpy arrays otherwise.
+            state: as in simulate
+        """
+        if state is None:
+            state = self.state
+
+        # The whole batch runs in C when the rollout library is built
+        if c_rollouts is not None:
+            payoffs = terminal_payoffs_array(state.dealer_value, state.dealer_aces, state.deck_counts)
+            return c_rollouts(DeckCountsArray(*state.deck_counts), state.my_value, state.my_aces,
+                              state.stand, payoffs, n, rollout_rng_state)
+        payoffs = terminal_payoffs_numpy(state.dealer_value, state.dealer_aces, state.deck_counts)
+
+        # Or as one compiled loop when numba is available
+        if njit is not None:
+            return rollouts(np.array(state.deck_counts), state.my_value, state.my_aces, state.stand, payoffs, n)
+
+        # Each simulation deals from its own shuffle of the remaining cards
+        remaining_values = np.repeat(RANK_VALUES_ARRAY, state.deck_counts)
+        shuffled_values = mcts_generator.permuted(np.tile(remaining_values, (n, 1)), axis=1)
+
+        values = np.full(n, state.my_value)
+        aces = np.full(n, state.my_aces)
+        active = np.full(n, not state.is_terminal())
+        step = 0
+        while active.any():
+
+            # Each unfinished simulation stands from ROLLOUT_STAND_VALUE, else flips a coin
+            hits = active & (values < ROLLOUT_STAND_VALUE) & (mcts_generator.random(n) < 0.5)
+            card_values = shuffled_values[:, step]
+            step += 1
+            values += np.where(hits, card_values, 0)
+            aces += hits & (card_values == 11)
+
+            # Adjust for aces (one card never needs more than one)
+            soften = (values > 21) & (aces > 0)
+            values -= 10 * soften
+            aces -= soften
+
+            active = hits & (values < 21)
+
+        return float(payoffs[np.minimum(values, 22)].sum())
     
-    def update_rewards(self, reward):
+    def update_rewards(self, reward, visits=1, path=None):
         """
         Updates the total reward and total visits of the node and all its parents.
+            path: the ancestors to update instead of the latest traversed ones
         """
-        parent_node = self
-        while parent_node is not None:
-            parent_node.total_rewards += reward
-            parent_node.total_visits += 1
-            parent_node = parent_node.parent
+        for node in path or self.ancestors:
+            node.total_rewards += reward
+            node.total_visits += visits
+            node.avg_reward = node.total_rewards / node.total_visits
 
     def __str__(self) -> str:
 
@@ -444,3 +1040,144 @@ class MonteCarloNode:
         """
 
         return string_form
+
+
+def run_mcts(start_state: BlackjackStateMCTS, explore_time: float, num_parallel_sims: int = 1,
+             use_transpositions: bool = False, rollouts_per_leaf: int = 1, num_simulations: int = None,
+             resample_hits: bool = True, node_table: dict = None):
+    """
+    Builds an MCTS tree from the given state for explore_time seconds.
+        rollouts_per_leaf: simulations per selected leaf, batched with numpy when above 1
+        num_simulations: if given, runs this many iterations instead of using explore_time
+        resample_hits: re-deal hit cards on every descent instead of once at expansion
+        node_table: transposition table of an earlier search of the same round to continue
+        from (with use_transpositions), filled in place
+        Returns the root node of the tree
+    """
+    # The plain search runs entirely in C when the rollout library is built
+    if c_mcts_search is not None and num_parallel_sims == 1 and not use_transpositions and resample_hits:
+        child_stats = run_mcts_compiled(start_state, explore_time, rollouts_per_leaf, num_simulations)
+        return MonteCarloNode.from_child_stats(start_state, [child_stats])
+
+    if not use_transpositions:
+        root = MonteCarloNode(start_state, None)
+        node_table = None
+    else:
+        if node_table is None:
+            node_table = {}
+        root = node_table.get(start_state.key())
+        if root is None:
+            root = MonteCarloNode(start_state, None)
+            node_table[start_state.key()] = root
+        else:
+            # Reuse the statistics gathered for this hand, searched from the live deck
+            root.state = start_state
+            root.ancestors = (root,)
+
+    iterations = 0
+    deadline = time.monotonic_ns() + int(explore_time * 1e9)
+    while (iterations < num_simulations if num_simulations is not None
+           else time.monotonic_ns() < deadline):
+        iterations += 1
+
+        # Gets a batch of leaf nodes in the UCB tree, adding a virtual loss
+        # (a visit with no reward) to each path so the selections diverge
+        leaves = []
+        for _ in range(num_parallel_sims):
+            node = root.find_leaf_node(node_table, resample_hits)
+            node.update_rewards(0)
+            # A later pick of the same node re-deals its state, so the one dealt now is kept
+            leaves.append((node, node.state, node.ancestors))
+
+        # Determines the random terminal value of each leaf and
+        # replaces its virtual loss with the real reward
+        for node, state, path in leaves:
+            if rollouts_per_leaf > 1:
+                node.update_rewards(node.simulate_batch(rollouts_per_leaf, state), visits=rollouts_per_leaf - 1, path=path)
+            else:
+                node.update_rewards(node.simulate(state), visits=0, path=path)
+
+    return root
+
+
+def run_mcts_compiled(start_state: BlackjackStateMCTS, explore_time: float, rollouts_per_leaf: int = 1,
+                      num_simulations: int = None):
+    """
+    Runs the search of run_mcts in the rollout library.
+        Returns {action: (visits, rewards)} for the expanded children of the root
+    """
+    child_visits = (ctypes.c_int64 * len(ACTIONS))()
+    child_rewards = (ctypes.c_double * len(ACTIONS))()
+    iterations = c_mcts_search(DeckCountsArray(*start_state.deck_counts), start_state.my_value,
+                               start_state.my_aces, start_state.dealer_value, start_state.dealer_aces,
+                               rollouts_per_leaf, -1 if num_simulations is None else num_simulations,
+                               int(explore_time * 1e9), rollout_rng_state, child_visits, child_rewards)
+    if iterations < 0:
+        raise MemoryError("Could not allocate the MCTS tree")
+    return {action: (child_visits[action], child_rewards[action]) for action in ACTIONS if child_visits[action]}
+
+
+def run_mcts_budget(start_state: BlackjackStateMCTS, explore_time: float, num_parallel_sims: int = 1,
+                    use_transpositions: bool = False, rollouts_per_leaf: int = 1,
+                    num_simulations: int = None, resample_hits: bool = True, seed: int = None):
+    """
+    Runs run_mcts in a worker process.
+        seed: reseeds the worker's random states so every search gets a distinct stream
+        Returns {action: (visits, rewards)} for the children of the root
+    """
+    if seed is not None:
+        seed_worker(seed)
+    root = run_mcts(start_state, explore_time, num_parallel_sims, use_transpositions, rollouts_per_leaf,
+                    num_simulations, resample_hits)
+    return {child.parent_action: (child.total_visits, child.total_rewards) for child in root.get_expanded_children()}
+
+
+# Worker pools for root-parallel MCTS, shared by every MonteCarloAgent
+_mcts_pools = {}
+
+def get_mcts_pool(num_workers: int):
+    """
+    Returns a persistent process pool with the given number of workers.
+    """
+    if num_workers not in _mcts_pools:
+        # Forked workers start with the module already imported (and the rollout kernel compiled)
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+        _mcts_pools[num_workers] = context.Pool(num_workers)
+    return _mcts_pools[num_workers]
+
+
+@atexit.register
+def close_mcts_pools():
+    """
+    Shuts down the worker pools before the interpreter tears down the modules they use.
+    """
+    for pool in _mcts_pools.values():
+        pool.close()
+        pool.join()
+    _mcts_pools.clear()
+
+
+def seed_worker(seed: int = None):
+    """
+    Reseeds the python, numpy and rollout kernel random states of a worker process.
+    """
+    mcts_random.seed(seed)
+    for i in range(4):
+        rollout_rng_state[i] = mcts_random.getrandbits(64) | 1
+    global mcts_generator
+    mcts_generator = np.random.default_rng(mcts_random.getrandbits(64))
+    seed_rollout(mcts_random.getrandbits(32))
+
+
+def seed_rollout(seed: int):
+    """
+    Seeds the random state used by the rollout kernel (numpy's global state without numba).
+    """
+    np.random.seed(seed)
+
+
+if njit is not None:
+    seed_rollout = njit(seed_rollout)
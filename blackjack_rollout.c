@@ -0,0 +1,405 @@
+/*
+ * Compiled MCTS rollouts and search for the Monte Carlo agent (see agents.py), and the
+ * table-driven round loop of Game.start_compiled (see game.py).
+ * Build with `make rollout`; agents.py loads it through ctypes when present.
+ */
+#include <math.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <time.h>
+
+#define NUM_RANKS 10
+
+/* Rollouts always stand from this value, matching agents.ROLLOUT_STAND_VALUE */
+#define ROLLOUT_STAND_VALUE 17
+
+/* Actions, matching agents.STAND and agents.HIT */
+#define STAND 0
+#define HIT 1
+
+/* Cards in one deck, matching cards.DECK_SIZE */
+#define DECK_SIZE 52
+
+/* Heat buckets of the Q-table states, matching agents.HEAT_INDEX */
+#define HOT_INDEX 0
+#define NEUTRAL_INDEX 1
+#define COLD_INDEX 2
+#define NUM_HEAT 3
+
+/* Point values of the ranks in agents.RANKS: 2-9, 10 (and faces), A */
+static const int32_t rank_values[NUM_RANKS] = {2, 3, 4, 5, 6, 7, 8, 9, 10, 11};
+
+static inline uint64_t rotl(const uint64_t x, int k) {
+    return (x << k) | (x >> (64 - k));
+}
+
+/* xoshiro256** generator, state is owned by the caller */
+static uint64_t xoshiro256starstar_next(uint64_t *s) {
+    const uint64_t result = rotl(s[1] * 5, 7) * 9;
+    const uint64_t t = s[1] << 17;
+
+    s[2] ^= s[0];
+    s[3] ^= s[1];
+    s[1] ^= s[2];
+    s[0] ^= s[3];
+    s[2] ^= t;
+    s[3] = rotl(s[3], 45);
+
+    return result;
+}
+
+/* Draws a rank weighted by (and removed from) the remaining counts */
+static int draw_rank(int32_t *counts, int32_t *total, uint64_t bits) {
+    int32_t pick = (int32_t)((bits & 0xffffffffu) % (uint64_t)*total);
+    int rank = 0;
+    while (pick >= counts[rank]) {
+        pick -= counts[rank];
+        rank++;
+    }
+    counts[rank]--;
+    (*total)--;
+    return rank;
+}
+
+/* Adds a card to a (value, soft aces) hand, mirroring agents.add_card_value */
+static inline void add_card_value(int32_t *value, int32_t *aces, int32_t card_value) {
+    *value += card_value;
+    if (card_value == 11) {
+        (*aces)++;
+    }
+    /* Count as many aces as 1 as it takes to get back to 21 or under */
+    int32_t over = *value - 21;
+    if (over > 0 && *aces) {
+        int32_t adjust = (over + 9) / 10;
+        if (adjust > *aces) {
+            adjust = *aces;
+        }
+        *value -= 10 * adjust;
+        *aces -= adjust;
+    }
+}
+
+/*
+ * Plays out the player's remaining actions at random (standing from ROLLOUT_STAND_VALUE)
+ * and scores the final hand.
+ *   deck_counts: remaining count of each rank (not modified)
+ *   payoffs: expected reward of each final player value from 0 to 22 (bust)
+ */
+static double rollout(const int32_t *deck_counts, int32_t my_value, int32_t my_aces, int32_t stand,
+               const double *payoffs, uint64_t *rng_state) {
+    int32_t counts[NUM_RANKS];
+    int32_t total = 0;
+    for (int rank = 0; rank < NUM_RANKS; rank++) {
+        counts[rank] = deck_counts[rank];
+        total += counts[rank];
+    }
+
+    /* Player's random actions */
+    while (my_value < 21 && !stand && total > 0) {
+        uint64_t bits = xoshiro256starstar_next(rng_state);
+        if (my_value >= ROLLOUT_STAND_VALUE || bits >> 63) {
+            stand = 1;
+            continue;
+        }
+
+        int rank = draw_rank(counts, &total, bits);
+        add_card_value(&my_value, &my_aces, rank_values[rank]);
+    }
+
+    return payoffs[my_value < 22 ? my_value : 22];
+}
+
+/*
+ * Returns the summed reward of n rollouts from the same state.
+ *   Batching amortizes the cost of calling in from python over many rollouts
+ */
+double rollouts(const int32_t *deck_counts, int32_t my_value, int32_t my_aces, int32_t stand,
+                const double *payoffs, int32_t n, uint64_t *rng_state) {
+    double total_reward = 0.0;
+    for (int32_t i = 0; i < n; i++) {
+        total_reward += rollout(deck_counts, my_value, my_aces, stand, payoffs, rng_state);
+    }
+    return total_reward;
+}
+
+/*
+ * Fills payoffs with the expected reward of standing on each player value from 0 to 22,
+ * mirroring agents.terminal_payoffs (every dealer draw uses the current proportions).
+ */
+static void terminal_payoffs(const int32_t *deck_counts, int32_t dealer_value, int32_t dealer_aces,
+                             double *payoffs) {
+    int32_t total = 0;
+    for (int rank = 0; rank < NUM_RANKS; rank++) {
+        total += deck_counts[rank];
+    }
+
+    /* Probability mass of each unfinished dealer hand by hard total and soft aces.
+       Every card raises the hard total, so one ascending pass finishes every hand */
+    double mass[27][2] = {{0.0}};
+    double dist[6] = {0.0};
+    mass[dealer_value - 10 * dealer_aces][dealer_aces] = 1.0;
+    for (int hard = 0; hard < 27; hard++) {
+        for (int aces = 0; aces < 2; aces++) {
+            double hand_mass = mass[hard][aces];
+            if (hand_mass == 0.0) {
+                continue;
+            }
+            int32_t value = hard + 10 * aces;
+            if (value >= 17) {
+                dist[(value < 22 ? value : 22) - 17] += hand_mass;
+                continue;
+            }
+            for (int rank = 0; rank < NUM_RANKS; rank++) {
+                if (deck_counts[rank] == 0) {
+                    continue;
+                }
+                int32_t next_value = value;
+                int32_t next_aces = aces;
+                add_card_value(&next_value, &next_aces, rank_values[rank]);
+                mass[next_value - 10 * next_aces][next_aces] += hand_mass * deck_counts[rank] / total;
+            }
+        }
+    }
+
+    for (int32_t my_value = 0; my_value < 23; my_value++) {
+        double payoff = 0.0;
+        if (my_value <= 21) {
+            for (int32_t dealer_final = 17; dealer_final < 23; dealer_final++) {
+                double p = dist[dealer_final - 17];
+                if (dealer_final > 21 || my_value > dealer_final) {
+                    payoff += p;
+                } else if (my_value == dealer_final) {
+                    payoff += 0.5 * p;
+                }
+            }
+        }
+        payoffs[my_value] = payoff;
+    }
+}
+
+/* Node of the compiled search tree. Nodes live in one growable array and refer to their
+   children by index, -1 until expanded; children are indexed by action */
+typedef struct {
+    int32_t children[2];
+    int64_t visits;
+    double rewards;
+} search_node;
+
+static int64_t monotonic_ns(void) {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (int64_t)now.tv_sec * 1000000000 + now.tv_nsec;
+}
+
+/*
+ * Runs the MCTS loop of agents.run_mcts (UCB selection, re-dealing hit cards on every
+ * descent, random rollouts scored against the dealer distribution without card removal).
+ *   num_simulations: iterations to run, or negative to run for explore_time_ns nanoseconds
+ *   child_visits, child_rewards: filled with the statistics of the root's children by action
+ *   Returns the number of iterations run, or -1 if the tree could not be allocated
+ */
+int64_t mcts_search(const int32_t *deck_counts, int32_t my_value, int32_t my_aces, int32_t dealer_value,
+                    int32_t dealer_aces, int32_t rollouts_per_leaf, int64_t num_simulations, int64_t explore_time_ns,
+                    uint64_t *rng_state, int64_t *child_visits, double *child_rewards) {
+    /* Each iteration expands at most one node, so a fixed budget never has to grow the arena */
+    int64_t capacity = num_simulations >= 0 ? num_simulations + 1 : 1024;
+    int64_t num_nodes = 1;
+    search_node *nodes = malloc(capacity * sizeof(search_node));
+    if (nodes == NULL) {
+        return -1;
+    }
+    nodes[0] = (search_node){{-1, -1}, 0, 0.0};
+
+    /* A path can hold at most one card per rank count plus the root and a stand */
+    int32_t path[64];
+    double payoffs[23];
+
+    /* The deadline comes from the clock it is checked against, not the caller's */
+    int64_t deadline_ns = monotonic_ns() + explore_time_ns;
+    int64_t iterations = 0;
+    while (num_simulations >= 0 ? iterations < num_simulations : monotonic_ns() < deadline_ns) {
+        iterations++;
+
+        /* Every descent starts from the root state */
+        int32_t counts[NUM_RANKS];
+        int32_t total = 0;
+        for (int rank = 0; rank < NUM_RANKS; rank++) {
+            counts[rank] = deck_counts[rank];
+            total += counts[rank];
+        }
+        int32_t value = my_value;
+        int32_t aces = my_aces;
+        int32_t stand = 0;
+
+        int32_t node = 0;
+        int depth = 0;
+        path[depth++] = node;
+        while (value < 21 && !stand) {
+            int32_t action;
+            int32_t stand_child = nodes[node].children[STAND];
+            int32_t hit_child = nodes[node].children[HIT];
+            int expanding = stand_child < 0 || hit_child < 0;
+
+            if (expanding) {
+                /* Stand is expanded first, like agents.ACTIONS read from the end */
+                action = stand_child < 0 ? STAND : HIT;
+                if (num_nodes == capacity) {
+                    search_node *grown = realloc(nodes, 2 * capacity * sizeof(search_node));
+                    if (grown == NULL) {
+                        free(nodes);
+                        return -1;
+                    }
+                    nodes = grown;
+                    capacity *= 2;
+                }
+                nodes[num_nodes] = (search_node){{-1, -1}, 0, 0.0};
+                nodes[node].children[action] = (int32_t)num_nodes;
+                node = (int32_t)num_nodes++;
+            } else {
+                /* Unvisited children are explored first, then the best UCB value */
+                int64_t stand_visits = nodes[stand_child].visits;
+                int64_t hit_visits = nodes[hit_child].visits;
+                if (stand_visits == 0) {
+                    action = STAND;
+                } else if (hit_visits == 0) {
+                    action = HIT;
+                } else {
+                    double exploration = sqrt(2 * log((double)nodes[node].visits));
+                    double stand_value = nodes[stand_child].rewards / stand_visits + exploration / sqrt((double)stand_visits);
+                    double hit_value = nodes[hit_child].rewards / hit_visits + exploration / sqrt((double)hit_visits);
+                    action = hit_value > stand_value ? HIT : STAND;
+                }
+                node = action == HIT ? hit_child : stand_child;
+            }
+            path[depth++] = node;
+
+            /* Re-deal the child's state (squashed chance node) */
+            if (action == HIT && total > 0) {
+                int rank = draw_rank(counts, &total, xoshiro256starstar_next(rng_state));
+                add_card_value(&value, &aces, rank_values[rank]);
+            } else {
+                stand = 1;
+            }
+
+            if (expanding) {
+                break;
+            }
+        }
+
+        /* Random rollouts from the leaf, back-propagated along the traversed path */
+        terminal_payoffs(counts, dealer_value, dealer_aces, payoffs);
+        double reward = 0.0;
+        for (int32_t i = 0; i < rollouts_per_leaf; i++) {
+            reward += rollout(counts, value, aces, stand, payoffs, rng_state);
+        }
+        for (int i = 0; i < depth; i++) {
+            nodes[path[i]].visits += rollouts_per_leaf;
+            nodes[path[i]].rewards += reward;
+        }
+    }
+
+    for (int action = 0; action < 2; action++) {
+        int32_t child = nodes[0].children[action];
+        child_visits[action] = child < 0 ? 0 : nodes[child].visits;
+        child_rewards[action] = child < 0 ? 0.0 : nodes[child].rewards;
+    }
+    free(nodes);
+    return iterations;
+}
+
+/* Value of a hand from its hard total (aces as 1) and number of aces, as in cards.Hand.add_card */
+static inline int32_t hand_value(int32_t hard_value, int32_t aces) {
+    return aces && hard_value <= 11 ? hard_value + 10 : hard_value;
+}
+
+/*
+ * Plays rounds as Game.play_round does, dealing from one shoe reshuffled once fewer than
+ * redeal_size cards are left, mirroring game.play_shoe_rounds.
+ *   shoe: card ints of every deck in the shoe (shuffled in place)
+ *   hard_points, aces_table, heat_table: cards.CARD_HARD_POINTS, CARD_ACES and CARD_HEAT
+ *   hit_table: whether the player hits, flattened from (dealer value, player value, has ace, heat index)
+ *   outcomes: set to the player wins, dealer wins and ties
+ */
+void play_shoe_rounds(uint8_t *shoe, int32_t shoe_size, const int32_t *hard_points, const int32_t *aces_table,
+                      const int32_t *heat_table, double redeal_size, const uint8_t *hit_table, int64_t rounds,
+                      uint64_t *rng_state, int64_t *outcomes) {
+    int32_t cursor = shoe_size;
+    int32_t heat = 0;
+    int64_t player_wins = 0, dealer_wins = 0, ties = 0;
+
+    for (int64_t round = 0; round < rounds; round++) {
+        if (shoe_size - cursor < redeal_size) {
+            /* Fisher-Yates shuffle */
+            for (int32_t i = shoe_size - 1; i > 0; i--) {
+                int32_t j = (int32_t)(xoshiro256starstar_next(rng_state) % (uint64_t)(i + 1));
+                uint8_t card = shoe[i];
+                shoe[i] = shoe[j];
+                shoe[j] = card;
+            }
+            cursor = 0;
+            heat = 0;
+        }
+
+        /* Deal 3 cards, the dealer's second card comes after the player's turn */
+        int32_t player_hard = 0, player_aces = 0;
+        for (int i = 0; i < 2; i++) {
+            uint8_t card = shoe[cursor++];
+            heat += heat_table[card];
+            player_hard += hard_points[card];
+            player_aces += aces_table[card];
+        }
+        uint8_t card = shoe[cursor++];
+        heat += heat_table[card];
+        int32_t dealer_hard = hard_points[card];
+        int32_t dealer_aces = aces_table[card];
+        int32_t dealer_card = hand_value(dealer_hard, dealer_aces);
+
+        /* Player's turn */
+        int32_t player_value = hand_value(player_hard, player_aces);
+        for (;;) {
+            double average_heat = (double)heat * DECK_SIZE / (shoe_size - cursor);
+            int heat_index = average_heat < -3 ? COLD_INDEX : (average_heat > 3 ? HOT_INDEX : NEUTRAL_INDEX);
+            int has_ace = player_aces > 0;
+            if (!hit_table[((dealer_card * 22 + player_value) * 2 + has_ace) * NUM_HEAT + heat_index]) {
+                break;
+            }
+            card = shoe[cursor++];
+            heat += heat_table[card];
+            player_hard += hard_points[card];
+            player_aces += aces_table[card];
+            player_value = hand_value(player_hard, player_aces);
+            if (player_value > 21) {
+                break;
+            }
+        }
+
+        /* Player busted! */
+        if (player_value > 21) {
+            dealer_wins++;
+            continue;
+        }
+
+        /* Dealer's turn */
+        int32_t dealer_value = dealer_card;
+        while (dealer_value < 17) {
+            card = shoe[cursor++];
+            heat += heat_table[card];
+            dealer_hard += hard_points[card];
+            dealer_aces += aces_table[card];
+            dealer_value = hand_value(dealer_hard, dealer_aces);
+        }
+
+        /* Determine winner (see cards.Hand.compute_winner) */
+        if (dealer_value > 21 || player_value > dealer_value) {
+            player_wins++;
+        } else if (player_value == dealer_value) {
+            ties++;
+        } else {
+            dealer_wins++;
+        }
+    }
+
+    outcomes[0] = player_wins;
+    outcomes[1] = dealer_wins;
+    outcomes[2] = ties;
+}
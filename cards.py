@@ -1,138 +1,281 @@
-from collections import defaultdict
-import random
+import numpy as np
 
-class Card:
-    def __init__(self, suit: str, value: str):
-        self.suit = suit
-        self.value = value
+# Hands only keep the list of their cards (shown by Hand.__repr__) when debugging,
+# since their values are tracked incrementally
+DEBUG = False
 
-    def __repr__(self):
-        return f"{self.value} of {self.suit}"
+# Random source of the deck shuffles, unless a deck is given its own
+_rng = np.random.default_rng()
+
+# Shuffled shoes (lists of cards) prepared in batches and handed out by Deck.deal_deck,
+# shared by the decks using _rng
+_shuffled_reserve = []
+
+def encode_card(suit: str, value: str) -> int:
+    """
+    Returns the int used for a card: the index of its suit in Deck.Suits in bits 4-5
+    and the index of its value in Deck.Values in bits 0-3.
+    """
+    return Deck.Suits.index(suit) << 4 | Deck.Values.index(value)
+
+def card_name(card: int) -> str:
+    """
+    Returns a readable name for a card int, e.g. "10 of H".
+    """
+    return f"{Deck.Values[card & 15]} of {Deck.Suits[card >> 4]}"
 
 class Deck:
 
     Deck_num = 2
     Redeal_percentage = 0.25
+    Reserve_size = 8
     Suits = ['H', 'D', 'C', 'S']
     Values = ['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']
 
-    Low_cards = set(['2', '3', '4', '5', '6'])
-    High_cards = set(['10', 'J', 'Q', 'K', 'A'])
+    # Point value of each card value (faces as 10, aces as 11) and its effect on the heat
+    # (low cards 2-6 cool the deck, tens and aces heat it)
+    Points = {'2': 2, '3': 3, '4': 4, '5': 5, '6': 6, '7': 7, '8': 8, '9': 9, '10': 10,
+              'J': 10, 'Q': 10, 'K': 10, 'A': 11}
+    Heat = {'2': -1, '3': -1, '4': -1, '5': -1, '6': -1, '7': 0, '8': 0, '9': 0, '10': 1,
+            'J': 1, 'Q': 1, 'K': 1, 'A': 1}
+
+    __slots__ = ("cards", "_cursor", "card_counts", "_heat", "_heat_average", "_heat_bucket", "version",
+                 "_rng", "_reserve")
+
+    def __init__(self, rng: np.random.Generator = None):
+        # A deck given its own random source also keeps its own reserve of shuffled shoes,
+        # so its shuffles are independent of (and reproducible apart from) every other deck
+        if rng is None:
+            self._rng = _rng
+            self._reserve = _shuffled_reserve
+        else:
+            self._rng = rng
+            self._reserve = []
 
-    def __init__(self):
+        # Bumped whenever the remaining cards change, so callers can cache derived values
+        self.version = 0
         self.deal_deck()
 
+    def __len__(self):
+        return len(self.cards) - self._cursor
+
     def start_round(self):
         """
         Checks if the deck needs to be reshuffled and reshuffles if necessary.
             Note: should only execute at the start of each game's round
         """
-        if len(self.cards) < len(Deck.Suits) * len(Deck.Values) * Deck.Deck_num * Deck.Redeal_percentage:
+        if len(self.cards) - self._cursor < DECK_SIZE * Deck.Deck_num * Deck.Redeal_percentage:
             self.deal_deck()
 
-    def deal_card(self) -> Card :
+    def deal_card(self) -> int:
         """
-        Returns a card from the deck and removes it from the deck.
+        Returns the next card of the shuffled deck and removes it from the deck.
         """
-
-        # Always get a random card out of the deck!
-        random.shuffle(self.cards)
-
-        removed_card = self.cards.pop()
-        if removed_card.value in Deck.Low_cards:
-            self._heat -= 1
-        elif removed_card.value in Deck.High_cards:
-            self._heat += 1
-
-        # Convert face cards to 10
-        card_value = "10" if removed_card.value in ['J', 'Q', 'K'] else removed_card.value
-        self.card_counts[card_value] -= 1
-
+        removed_card = self.cards[self._cursor]
+        self._cursor += 1
+        self.version += 1
+        self._heat_average = None
+        self._heat_bucket = None
+        self._heat += CARD_HEAT[removed_card]
+        self.card_counts[CARD_POINTS[removed_card]] -= 1
         return removed_card
 
-    def deal_deck(self):
-
-        self.cards = [Card(suit, value) for suit in Deck.Suits for value in Deck.Values] * Deck.Deck_num
-        random.shuffle(self.cards)
+    def deal_cards(self, n: int) -> list:
+        """
+        Returns the next n cards of the shuffled deck and removes them from the deck.
+            Note: same as n calls to deal_card, with the bookkeeping done once
+        """
+        cursor = self._cursor
+        removed_cards = self.cards[cursor:cursor + n]
+        self._cursor = cursor + n
+        self.version += 1
+        self._heat_average = None
+        self._heat_bucket = None
+        card_counts = self.card_counts
+        for card in removed_cards:
+            self._heat += CARD_HEAT[card]
+            card_counts[CARD_POINTS[card]] -= 1
+        return removed_cards
 
-        self.card_counts = defaultdict(int)
-        for value in Deck.Values:
-            if value.isnumeric():
-                self.card_counts[value] += Deck.Deck_num * len(Deck.Suits)
-            elif value != 'A':
-                self.card_counts["10"] += Deck.Deck_num * len(Deck.Suits)
-            else:
-                self.card_counts["A"] += Deck.Deck_num * len(Deck.Suits)
+    def deal_deck(self):
+        """
+        Shuffles a fresh deck once; cards are then dealt in order from a cursor.
+            Note: cards are ints (see encode_card), kept in a list so dealing reads plain ints
+        """
+        # Shoes are shuffled Reserve_size at a time, and again if Deck_num changed
+        shoe_size = DECK_SIZE * Deck.Deck_num
+        reserve = self._reserve
+        if not reserve or len(reserve[-1]) != shoe_size:
+            shoes = self._rng.permuted(np.tile(UNIQUE_CARDS, (Deck.Reserve_size, Deck.Deck_num)), axis=1)
+            reserve[:] = shoes.tolist()
+        self.cards = reserve.pop()
+        self._cursor = 0
+
+        # Remaining cards by point value (index 2-11, faces as 10 and aces as 11),
+        # a list since every deal updates one entry
+        self.card_counts = [count * Deck.Deck_num for count in UNIQUE_CARD_COUNTS]
 
         self._heat = 0
+        self._heat_average = None
+        self._heat_bucket = None
+        self.version += 1
 
     def get_probability(self, card_value: str) -> float:
         """
         Returns the probability of drawing a card with the given value.
         """
-        card_value = "10" if card_value in ['J', 'Q', 'K'] else card_value
-        return self.card_counts[card_value] / len(self.cards)
+        return self.card_counts[Deck.Points[card_value]] / len(self)
 
     @property
     def heat(self):
         """
         Returns the average heat of the deck.
+            Note: cached until the next card is dealt or the deck is reshuffled
         """
-        number_of_decks = len(self.cards) / (len(Deck.Suits) * len(Deck.Values))
-        average_heat = self._heat / number_of_decks
-        return average_heat
+        if self._heat_average is None:
+            # Heat per remaining 52-card deck
+            self._heat_average = self._heat * DECK_SIZE / (len(self.cards) - self._cursor)
+        return self._heat_average
+
+    @property
+    def heat_bucket(self):
+        """
+        Returns 'cold', 'hot' or 'nuetral' for the current heat of the deck.
+            Note: cached until the next card is dealt or the deck is reshuffled
+        """
+        if self._heat_bucket is None:
+            heat = self.heat
+            if heat < -3:
+                self._heat_bucket = 'cold'
+            elif heat > 3:
+                self._heat_bucket = 'hot'
+            else:
+                self._heat_bucket = 'nuetral'
+        return self._heat_bucket
+
+    def clone(self):
+        """
+        Returns a copy of the deck that can be dealt from independently.
+            Note: the shuffled cards are never mutated, so the copy shares them
+        """
+        deck = Deck.__new__(Deck)
+        deck.cards = self.cards
+        deck._cursor = self._cursor
+        deck.card_counts = self.card_counts.copy()
+        deck._heat = self._heat
+        deck._heat_average = self._heat_average
+        deck._heat_bucket = self._heat_bucket
+        deck.version = self.version
+        deck._rng = self._rng
+        deck._reserve = self._reserve
+        return deck
+
+    __copy__ = clone
 
     def get_unique_cards(self):
         """
         Returns the unique cards in the deck.
         """
-        return [k for k, v in self.card_counts.items() if v > 0]
+        return ['A' if points == 11 else str(points) for points in range(2, 12) if self.card_counts[points] > 0]
 
     def __repr__(self):
-        return f"Deck of {len(self.cards)} cards"
+        return f"Deck of {len(self)} cards"
+
+# Every card of one deck, and the point value and heat effect of each card int
+UNIQUE_CARDS = np.array([encode_card(suit, value) for suit in Deck.Suits for value in Deck.Values], dtype=np.uint8)
+DECK_SIZE = len(UNIQUE_CARDS)
+CARD_POINTS = tuple(Deck.Points[Deck.Values[card & 15]] if card & 15 < len(Deck.Values) else 0 for card in range(64))
+CARD_HEAT = tuple(Deck.Heat[Deck.Values[card & 15]] if card & 15 < len(Deck.Values) else 0 for card in range(64))
+
+# Point value of each card int counting aces as 1, and whether the card is an ace
+CARD_HARD_POINTS = tuple(1 if points == 11 else points for points in CARD_POINTS)
+CARD_ACES = tuple(int(points == 11) for points in CARD_POINTS)
+
+# Cards of one deck by point value (index 2-11), as in Deck.card_counts
+UNIQUE_CARD_COUNTS = tuple(np.bincount([CARD_POINTS[card] for card in UNIQUE_CARDS.tolist()], minlength=12).tolist())
 
 class Hand:
 
+    __slots__ = ("cards", "value", "hard_value", "aces", "version")
+
     def __init__(self):
+        # Only filled in when DEBUG is set
         self.cards = []
         self.value = 0
+
+        # Total with every ace counted as 1, and number of aces held
+        self.hard_value = 0
         self.aces = 0
 
+        # Bumped on every change, so callers can cache values derived from the hand
+        self.version = 0
+
     def reset(self):
         """
         Resets the hand.
         """
-        self.cards = []
+        if DEBUG:
+            self.cards = []
         self.value = 0
+        self.hard_value = 0
         self.aces = 0
+        self.version += 1
 
-    def add_card(self, card: Card):
+    def clone(self):
+        """
+        Returns a copy of the hand.
+        """
+        hand = Hand.__new__(Hand)
+        hand.cards = self.cards[:]
+        hand.value = self.value
+        hand.hard_value = self.hard_value
+        hand.aces = self.aces
+        hand.version = self.version
+        return hand
+
+    __copy__ = clone
+
+    def add_card(self, card: int):
         """
         Adds a card to the hand and updates the value of the hand.
         """
-        self.cards.append(card)
-        self.update_value(card)
+        if DEBUG:
+            self.cards.append(card)
+
+        # Card value with aces counting as 1 here
+        hard_value = self.hard_value + CARD_HARD_POINTS[card]
+        aces = self.aces + CARD_ACES[card]
+        self.hard_value = hard_value
+        self.aces = aces
+
+        # At most one ace can count as 11 without busting
+        self.value = hard_value + 10 if aces and hard_value <= 11 else hard_value
+        self.version += 1
 
-    def update_value(self, card: Card):
+    def add_cards(self, cards: list):
         """
-        Updates the value of the hand.
+        Adds several cards to the hand and updates the value of the hand once.
         """
+        if DEBUG:
+            self.cards.extend(cards)
 
-        # Determine card value
-        card_value = 0
-        if card.value.isnumeric():
-            card_value = int(card.value)
-        elif card.value == 'A':
-            card_value = 11
-            self.aces += 1
-        else:
-            card_value = 10
-        self.value += card_value
+        hard_value = self.hard_value
+        aces = self.aces
+        for card in cards:
+            hard_value += CARD_HARD_POINTS[card]
+            aces += CARD_ACES[card]
+        self.hard_value = hard_value
+        self.aces = aces
+
+        self.value = hard_value + 10 if aces and hard_value <= 11 else hard_value
+        self.version += 1
 
-        # Adjust for aces
-        while self.value > 21 and self.aces:
-            self.value -= 10
-            self.aces -= 1
+    @property
+    def is_soft(self):
+        """
+        Returns True if an ace is currently counted as 11.
+        """
+        return self.value != self.hard_value
 
     def compute_winner(self, dealer_hand):
         """
@@ -163,4 +306,6 @@ class Hand:
 
 
     def __repr__(self):
-        return f"Hand: {' '.join(map(str, self.cards))} (Value: {self.value})"
+        if not DEBUG:
+            return f"Hand (Value: {self.value})"
+        return f"Hand: {' '.join(map(card_name, self.cards))} (Value: {self.value})"
@@ -1,84 +1,393 @@
-from cards import Deck
-from agents import Agent, DealerAgent, QLearnAgent, MonteCarloAgent
+import ctypes
+import multiprocessing
+import numpy as np
+from cards import Deck, UNIQUE_CARDS, DECK_SIZE, CARD_POINTS, CARD_HEAT, CARD_HARD_POINTS, CARD_ACES
+from agents import Agent, DealerAgent, QLearnAgent, MonteCarloAgent, add_card_values, seed_worker, c_play_shoe_rounds, HEAT_INDEX
+
+# Numba is optional: without it (or the C kernel) Game.start_compiled runs its loop in plain Python
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Heat indices of the Q-table, as plain ints for the round kernel
+HOT_INDEX = HEAT_INDEX['hot']
+NEUTRAL_INDEX = HEAT_INDEX['nuetral']
+COLD_INDEX = HEAT_INDEX['cold']
 
 class Game:
-    def __init__(self, player_agent: Agent, player_args: dict, dealer_agent: Agent, rounds=1, q_table=None):
-        self.deck = Deck()
+    def __init__(self, player_agent: Agent, player_args: dict, dealer_agent: Agent, rounds=1, q_table=None, seed=None):
+        # A seed gives the game its own random sources, so a run can be repeated: independent seeds
+        # for the game's deck, the training of a QLearnAgent and the rounds played are spawned from it
+        self.seed = seed
+        if seed is None:
+            self.deck = Deck()
+            self.training_seed = None
+            self.round_seed = None
+        else:
+            deck_seed, self.training_seed, self.round_seed = spawn_seeds(seed, 3)
+            self.deck = Deck(np.random.default_rng(deck_seed))
         self.player_agent = player_agent
         self.player_args = player_args
         self.dealer_agent = dealer_agent
         self.rounds = rounds
         self.q_table = q_table
 
+        # The player and dealer play every round, with their hands reset in between
+        if self.player_agent == QLearnAgent:
+            self.player = self.player_agent(self.deck, self.q_table)
+        else:
+            self.player = self.player_agent(self.deck, **self.player_args)
+        self.dealer = self.dealer_agent(self.deck)
+
     def play_round(self):
 
         self.deck.start_round()
-        # Update players decks
-        self.player_agent.deck = self.deck
-        self.dealer_agent.deck = self.deck
-        if self.player_agent == QLearnAgent:
-            player = self.player_agent(self.deck, self.q_table)
-        else:
-          player = self.player_agent(self.deck, **self.player_args)
-        dealer = self.dealer_agent(self.deck)
+        player = self.player
+        dealer = self.dealer
 
         # if the player already has cards, reset them
-        player.hand.reset()
-        dealer.hand.reset()
+        player.reset()
+        dealer.reset()
 
         # Deal 3 cards
         # Note: not giving dealer 2 cards now because
         # it will provide extra information of unrevealed card
-        c1 = self.deck.deal_card()
-        c2 = self.deck.deal_card()
-        c3 = self.deck.deal_card()
+        c1, c2, c3 = self.deck.deal_cards(3)
 
-        player.hand.add_card(c1)
-        player.hand.add_card(c2)
+        player.hand.add_cards((c1, c2))
         dealer.hand.add_card(c3)
 
         # Player's turn
-        while player.policy(dealer.hand):
-            player.hit()
-            #Player busted!
-            if player.hand.value > 21:
-                return 0
+        player.play_turn(dealer.hand)
+        #Player busted!
+        if player.hand.value > 21:
+            return 0
 
         c4 = self.deck.deal_card()
         dealer.hand.add_card(c4)
 
         # Dealer's turn
-        while dealer.policy(player.hand):
-            dealer.hit()
+        dealer.play_turn(player.hand)
 
         # Determine winner
         return player.hand.compute_winner(dealer.hand)
 
-    def start(self):
+    def train_player(self):
+        """
+        Trains the player first if it is a QLearnAgent.
+        """
+        if self.player_agent == QLearnAgent:
+            # make a deck to use for training
+            if self.training_seed is None:
+                training_deck = Deck()
+            else:
+                training_deck = Deck(np.random.default_rng(self.training_seed))
+            training_player = self.player_agent(training_deck, seed=self.training_seed)
+            q_table = training_player.train(self.player_args['training_rounds'], self.player_args.get('training_batch_size', 1)) # train for 1 million rounds
+            # training_player.print_q_table() # print the q_table
+            self.q_table = q_table # set the q_table to the trained q_table
+            self.player.q_table = q_table
+
+    def play_rounds(self, rounds):
+        """
+        Plays the given number of rounds and returns how many ended with each result.
+            1 = player wins, 0 = dealer wins, 0.5 = tie
+        """
+        # The MCTS random states are shared by every game, so they are seeded when the rounds start
+        if self.round_seed is not None:
+            seed_worker(self.round_seed)
+
+        outcomes = {1: 0, 0: 0, 0.5: 0}
+        play_round = self.play_round
+        for _ in range(rounds):
+            outcomes[play_round()] += 1
+        return outcomes
+
+    def start(self, num_workers=1):
+        """
+        Plays every round and returns the player win, dealer win and tie rates.
+            num_workers: processes sharing the rounds, each playing its own game and deck
+            Note: the player is trained once before the rounds are shared out, and a MonteCarloAgent
+            cannot use num_workers of its own inside a worker
+        """
+        # if it is a QLearnAgent, train it first
+        self.train_player()
+
+        outcomes = self.play_shared("play_rounds", num_workers)
+        return outcomes[1]/self.rounds, outcomes[0]/self.rounds, outcomes[0.5]/self.rounds
+
+    def play_shared(self, play_method, num_workers, *args):
+        """
+        Plays every round with the given play method (e.g. "play_rounds"), sharing them out to
+        num_workers processes, and returns how many ended with each result.
+        """
+        if num_workers <= 1:
+            return getattr(self, play_method)(self.rounds, *args)
+
+        # Root parallelization: independent games per worker, results summed at the end
+        shares = [self.rounds // num_workers + (worker < self.rounds % num_workers) for worker in range(num_workers)]
+        seeds = spawn_seeds(self.round_seed, num_workers)
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+        with context.Pool(num_workers) as pool:
+            worker_outcomes = pool.starmap(play_game_rounds, [
+                (self.player_agent, self.player_args, self.dealer_agent, share, self.q_table, seed, play_method, args)
+                for share, seed in zip(shares, seeds)])
+        return {result: sum(counts[result] for counts in worker_outcomes) for result in (1, 0, 0.5)}
+
+    def start_batched(self, batch_size=4096, num_workers=1):
+        """
+        Plays the rounds like start, with batch_size independent shoes dealt side by side as numpy arrays.
+            num_workers: processes sharing the rounds, as in start
+            Note: only policies with a hit_table can be batched, so the player must be a
+            QLearnAgent or DealerAgent and the dealer a DealerAgent
+        """
+        if self.player_agent not in (QLearnAgent, DealerAgent) or self.dealer_agent != DealerAgent:
+            raise TypeError(f"Cannot batch {self.player_agent.__name__} against {self.dealer_agent.__name__}")
+
+        # if it is a QLearnAgent, train it first
+        self.train_player()
+
+        outcomes = self.play_shared("play_rounds_batched", num_workers, batch_size)
+        return outcomes[1]/self.rounds, outcomes[0]/self.rounds, outcomes[0.5]/self.rounds
+
+    def play_rounds_batched(self, rounds, batch_size=4096):
+        """
+        Plays the given number of rounds in numpy batches (see start_batched) and returns how many
+        ended with each result.
+        """
+        generator = np.random.default_rng(self.round_seed)
+        hit_table = self.player.hit_table()
+        points_table = np.array(CARD_POINTS)
+        heat_table = np.array(CARD_HEAT)
+        shoe_size = DECK_SIZE * Deck.Deck_num
+
+        # Every lane is a shoe playing its own sequence of rounds
+        lanes = min(batch_size, rounds)
+        rows = np.arange(lanes)
+        shoe_points = np.zeros((lanes, shoe_size), dtype=int)
+        shoe_heat = np.zeros((lanes, shoe_size), dtype=int)
+        cursor = np.full(lanes, shoe_size)
+        heat = np.zeros(lanes, dtype=int)
+
+        def deal(mask):
+            """
+            Deals the next card of the shoes in mask, returning 0 for the other lanes.
+            """
+            index = np.minimum(cursor, shoe_size - 1)
+            card_points = np.where(mask, shoe_points[rows, index], 0)
+            heat[mask] += shoe_heat[rows, index][mask]
+            cursor[mask] += 1
+            return card_points
 
         player_wins = 0
         dealer_wins = 0
         ties = 0
+        played = 0
+        while played < rounds:
+
+            # Reshuffle the shoes that run low (see Deck.start_round)
+            low = shoe_size - cursor < shoe_size * Deck.Redeal_percentage
+            if low.any():
+                shoes = generator.permuted(np.tile(UNIQUE_CARDS, (low.sum(), Deck.Deck_num)), axis=1)
+                shoe_points[low] = points_table[shoes]
+                shoe_heat[low] = heat_table[shoes]
+                cursor[low] = 0
+                heat[low] = 0
+
+            # Deal 3 cards, the dealer's second card comes after the player's turn
+            everyone = np.ones(lanes, dtype=bool)
+            first_card = deal(everyone)
+            second_card = deal(everyone)
+            dealer_card = deal(everyone)
+            player_value, player_aces = add_card_values(first_card, (first_card == 11).astype(int), second_card)
+            player_has_ace = ((first_card == 11) | (second_card == 11)).astype(int)
+            dealer_value, dealer_aces = dealer_card.copy(), (dealer_card == 11).astype(int)
+
+            # Player's turn, hitting from the table for the state of QLearnAgent._get_state
+            acting = everyone
+            while acting.any():
+                average_heat = heat * DECK_SIZE / (shoe_size - cursor)
+                heat_index = np.where(average_heat < -3, HEAT_INDEX['cold'],
+                                      np.where(average_heat > 3, HEAT_INDEX['hot'], HEAT_INDEX['nuetral']))
+                hits = acting & hit_table[dealer_card, np.minimum(player_value, 21), player_has_ace, heat_index]
+                card_points = deal(hits)
+                player_value, player_aces = add_card_values(player_value, player_aces, card_points)
+                player_has_ace |= card_points == 11
+                acting = hits & (player_value <= 21)
+            player_bust = player_value > 21
+
+            # Dealer's turn
+            dealing = ~player_bust
+            dealer_value, dealer_aces = add_card_values(dealer_value, dealer_aces, deal(dealing))
+            dealing &= dealer_value < 17
+            while dealing.any():
+                dealer_value, dealer_aces = add_card_values(dealer_value, dealer_aces, deal(dealing))
+                dealing &= dealer_value < 17
+
+            # Determine winners (see Hand.compute_winner), counting only the rounds asked for
+            counted = rows < rounds - played
+            won = ~player_bust & ((dealer_value > 21) | (player_value > dealer_value))
+            tied = ~player_bust & (dealer_value <= 21) & (player_value == dealer_value)
+            player_wins += int(np.count_nonzero(won & counted))
+            ties += int(np.count_nonzero(tied & counted))
+            dealer_wins += int(np.count_nonzero(~won & ~tied & counted))
+            played += lanes
+
+        return {1: player_wins, 0: dealer_wins, 0.5: ties}
+
+    def start_compiled(self, num_workers=1):
+        """
+        Plays the rounds like start from a single shoe, in one compiled loop: the C kernel of
+        blackjack_rollout.c when it is built, otherwise numba when it is installed.
+            num_workers: processes sharing the rounds, as in start
+            Note: the player's hits come from a table, so as with start_batched the player must be a
+            QLearnAgent or DealerAgent and the dealer a DealerAgent
+        """
+        if self.player_agent not in (QLearnAgent, DealerAgent) or self.dealer_agent != DealerAgent:
+            raise TypeError(f"Cannot compile {self.player_agent.__name__} against {self.dealer_agent.__name__}")
 
         # if it is a QLearnAgent, train it first
-        if self.player_agent == QLearnAgent:
-            # make a deck to use for training
-            training_deck = Deck()
-            training_player = self.player_agent(training_deck)
-            q_table = training_player.train(self.player_args['training_rounds']) # train for 1 million rounds
-            # training_player.print_q_table() # print the q_table
-            self.q_table = q_table # set the q_table to the trained q_table
-
+        self.train_player()
+
+        outcomes = self.play_shared("play_rounds_compiled", num_workers)
+        return outcomes[1]/self.rounds, outcomes[0]/self.rounds, outcomes[0.5]/self.rounds
+
+    def play_rounds_compiled(self, rounds):
+        """
+        Plays the given number of rounds with play_shoe_rounds (see start_compiled) and returns how many
+        ended with each result.
+        """
+        hit_table = self.player.hit_table()
+        shoe = np.tile(UNIQUE_CARDS, Deck.Deck_num)
+        redeal_size = DECK_SIZE * Deck.Deck_num * Deck.Redeal_percentage
+
+        if c_play_shoe_rounds is not None:
+            # xoshiro256** state of the C kernel, from the game's seed
+            rng_state = (ctypes.c_uint64 * 4)(*np.random.SeedSequence(self.round_seed).generate_state(4, np.uint64).tolist())
+            outcomes = (ctypes.c_int64 * 3)()
+            hits = np.ascontiguousarray(hit_table, dtype=np.uint8)
+            c_play_shoe_rounds(
+                shoe.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)), len(shoe),
+                (ctypes.c_int32 * len(CARD_HARD_POINTS))(*CARD_HARD_POINTS),
+                (ctypes.c_int32 * len(CARD_ACES))(*CARD_ACES),
+                (ctypes.c_int32 * len(CARD_HEAT))(*CARD_HEAT), redeal_size,
+                hits.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)), rounds, rng_state, outcomes)
+            player_wins, dealer_wins, ties = outcomes
+        else:
+            if self.round_seed is not None:
+                seed_round_kernel(self.round_seed)
+            player_wins, dealer_wins, ties = play_shoe_rounds(
+                shoe, np.array(CARD_HARD_POINTS), np.array(CARD_ACES), np.array(CARD_HEAT),
+                redeal_size, hit_table, rounds)
+        return {1: player_wins, 0: dealer_wins, 0.5: ties}
+
+def play_shoe_rounds(shoe, hard_points, aces_table, heat_table, redeal_size, hit_table, rounds):
+    """
+    Plays rounds as Game.play_round does, dealing from one shoe reshuffled once fewer than redeal_size
+    cards are left, and returns the player wins, dealer wins and ties.
+        shoe: card ints of every deck in the shoe (shuffled in place)
+        hard_points, aces_table, heat_table: CARD_HARD_POINTS, CARD_ACES and CARD_HEAT as arrays
+        hit_table: whether the player hits, by (dealer value, player value, has ace, heat index)
+    """
+    shoe_size = len(shoe)
+    cursor = shoe_size
+    heat = 0
+    player_wins = 0
+    dealer_wins = 0
+    ties = 0
+    for _ in range(rounds):
+        if shoe_size - cursor < redeal_size:
+            np.random.shuffle(shoe)
+            cursor = 0
+            heat = 0
+
+        # Hands are tracked as in Hand.add_card: a hard value with aces as 1, and the aces held
+        player_hard = 0
+        player_aces = 0
+        for _ in range(2):
+            card = shoe[cursor]
+            cursor += 1
+            heat += heat_table[card]
+            player_hard += hard_points[card]
+            player_aces += aces_table[card]
+        card = shoe[cursor]
+        cursor += 1
+        heat += heat_table[card]
+        dealer_hard = hard_points[card]
+        dealer_aces = aces_table[card]
+        dealer_card = dealer_hard + 10 if dealer_aces else dealer_hard
 
-        for i in range(self.rounds):
-            result = self.play_round()
-            if result == 1:
-                player_wins += 1
-            elif result == 0:
-                dealer_wins += 1
+        # Player's turn
+        player_value = player_hard + 10 if player_aces and player_hard <= 11 else player_hard
+        while True:
+            average_heat = heat * DECK_SIZE / (shoe_size - cursor)
+            if average_heat < -3:
+                heat_index = COLD_INDEX
+            elif average_heat > 3:
+                heat_index = HOT_INDEX
             else:
-                ties += 1
-        return player_wins/self.rounds, dealer_wins/self.rounds, ties/self.rounds
+                heat_index = NEUTRAL_INDEX
+            if not hit_table[dealer_card, player_value, min(player_aces, 1), heat_index]:
+                break
+            card = shoe[cursor]
+            cursor += 1
+            heat += heat_table[card]
+            player_hard += hard_points[card]
+            player_aces += aces_table[card]
+            player_value = player_hard + 10 if player_aces and player_hard <= 11 else player_hard
+            if player_value > 21:
+                break
+
+        #Player busted!
+        if player_value > 21:
+            dealer_wins += 1
+            continue
+
+        # Dealer's turn
+        dealer_value = dealer_card
+        while dealer_value < 17:
+            card = shoe[cursor]
+            cursor += 1
+            heat += heat_table[card]
+            dealer_hard += hard_points[card]
+            dealer_aces += aces_table[card]
+            dealer_value = dealer_hard + 10 if dealer_aces and dealer_hard <= 11 else dealer_hard
+
+        # Determine winner (see Hand.compute_winner)
+        if dealer_value > 21 or player_value > dealer_value:
+            player_wins += 1
+        elif player_value == dealer_value:
+            ties += 1
+        else:
+            dealer_wins += 1
+    return player_wins, dealer_wins, ties
+
+def seed_round_kernel(seed: int):
+    """
+    Seeds the random state used by play_shoe_rounds.
+    """
+    np.random.seed(seed)
+
+if njit is not None:
+    play_shoe_rounds = njit(cache=True)(play_shoe_rounds)
+    seed_round_kernel = njit(seed_round_kernel)
+
+def spawn_seeds(seed: int, n: int):
+    """
+    Returns n independent int seeds spawned from seed (fresh entropy when seed is None).
+    """
+    return [int(child.generate_state(1)[0]) for child in np.random.SeedSequence(seed).spawn(n)]
+
+def play_game_rounds(player_agent, player_args, dealer_agent, rounds, q_table, seed, play_method="play_rounds", args=()):
+    """
+    Plays rounds of a new game seeded with seed in a worker process (see Game.play_shared).
+    """
+    game = Game(player_agent, player_args, dealer_agent, rounds=rounds, q_table=q_table, seed=seed)
+    return getattr(game, play_method)(rounds, *args)
 
 if __name__ == "__main__":
     print("Welcome to Blackjack! executing simulations in game.py\n")
@@ -103,8 +412,10 @@ if __name__ == "__main__":
     # That is, instead of picking a node based on the probability distribution, I could just draw a card from the deck
     # (which inherently models the probabilty distribution) and update the live deck as we traverse down the tree.
     # This results in each mcts tree node's game state slightly changing as we traverse as a result of different cards being randomly drawn,
-    # but they still consistently represent hit or stand nodes as originally created. One drawback of this implementation is that we need 
-    # to create deepcopies of the deck each iteration so that we have the same starting deck each time!
+    # but they still consistently represent hit or stand nodes as originally created. One drawback of this implementation was that we needed
+    # to create deepcopies of the deck each iteration so that we have the same starting deck each time! The tree states now only hold
+    # the hand values and the remaining count of each rank, so re-dealing a node is a cheap integer update (Deck.clone and copy.copy
+    # give a cheap independent deck when a live one is needed)
 
     ## MCTS Agent Results ##
 